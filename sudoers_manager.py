@@ -30,6 +30,19 @@
 ########
 # Update History
 #
+# 1.11.0    2026/10/18  Added NDJSON export and import of rules.
+# 1.10.0    2026/10/18  Added a batch mode that makes the same changes to many
+#                       sudoers files (or roots) at once.
+# 1.9.0     2026/10/18  Added an optional SQLite rule store that can be used as the
+#                       source of truth for the sudoers file.
+# 1.8.0     2026/10/18  Section end markers carry a checksum of the section, which
+#                       is used to spot hand edits and skip unchanged sections.
+# 1.7.0     2026/10/18  Each section can check whether it has a rule without a
+#                       search.
+# 1.6.0     2026/10/18  Added desired-state files so that separate owners can each
+#                       converge their own tagged subset of rules.
+# 1.5.0     2026/10/18  Added a watch mode that keeps the sudoers file reconciled,
+#                       re-rendering only when a section drifts.
 # 1.4.0     2016/04/15  Added option to simply discard existing sudoers file.
 # 1.3.2     2015/08/04  Fixed rule retrieval to properly sort all rules. Also
 #                       adjusted filtering so 'Defaults:' will move be pushed to
@@ -53,12 +66,30 @@
 
 import argparse
 import collections
+import ctypes
+import ctypes.util
 import datetime
+import errno
+import fcntl
+import hashlib
+import itertools
+import json
+import multiprocessing.pool
 import os
+import select
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+
+# The rule store (--store) needs sqlite3, which not every Python build has.
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 
 ########
 ## Attributes
@@ -66,7 +97,7 @@ import tempfile
 attributes = {
     'long_name': 'Sudoers Manager',
     'name':      os.path.basename(sys.argv[0]),
-    'version':   '1.4.0'
+    'version':   '1.11.0'
 }
 
 ########
@@ -211,12 +242,10 @@ def build_clean_from_template(to_file):
     """
     file_text = comment_header
     for section in sections:
-        # For each section, add the comment, add the start/stop points, and add
-        # whatever rules were declared for the section.
+        # For each section, add the comment and the start/stop points. The
+        # rules themselves are filled in afterward by write_rules().
         file_text += comments[section]
         file_text += '#@start {}\n'.format(section)
-        for rule in rules[section]:
-            file_text += '{}\n'.format(rule)
         file_text += '#@end {}\n'.format(section)
     # Write the new file to the given location.
     with open(to_file, 'w') as f:
@@ -227,7 +256,7 @@ def write_rules(rules, to_file):
     Takes a list of rules and writes the changes to the given sudoers file. This
     will keep all commented lines intact (this is non-destructive to the file).
 
-    :param rules: A dictionary mapping section names to a list of rules for that
+    :param rules: A dictionary mapping section names to the RuleList for that
         section.
     :param to_file: The absolute path to the desired sudoers file.
     """
@@ -246,7 +275,13 @@ def write_rules(rules, to_file):
             while not section_written[section]:
                 # Pull a line.
                 line = text[index]
-                if line.strip().startswith('#') or line.strip() == '':
+                if '#@end {}'.format(section) in line:
+                    # If the line was the end line, then the section is done.
+                    # Mark it with a checksum of what we wrote.
+                    f.write('#@end {} sha256={}'.format(section, section_digest(rules[section])))
+                    f.write('\n')
+                    section_written[section] = True
+                elif line.strip().startswith('#') or line.strip() == '':
                     # If the line is a comment or blank space, just write it
                     # back without changes.
                     f.write(line)
@@ -256,9 +291,6 @@ def write_rules(rules, to_file):
                     for rule in rules[section]:
                         f.write(rule)
                         f.write('\n')
-                elif '#@end {}'.format(section) in line:
-                    # If the line was the end line, then the section is done.
-                    section_written[section] = True
                 # Keep moving over the lines.
                 index += 1
 
@@ -301,21 +333,23 @@ def validate(sudoers_file):
 
     :param sudoers_file: The absolute path to the sudoers file.
     """
-    file_text = None
-    # Read in the current sudoers file.
-    with open(sudoers_file) as f:
-        file_text = f.read().split('\n')
-    # Iterate over the lines, finding all instances of the @start and @stop
-    # keywords for each section.
+    # Iterate over the lines of the current sudoers file (without reading it all
+    # in at once), finding all instances of the @start and @stop keywords for
+    # each section.
     section_tags = {section: (None, None) for section in sections}
-    for i in xrange(0, len(file_text)):
-        for section in sections:
-            if file_text[i] == "#@start {}".format(section):
-                section_tags[section] = (i, section_tags[section][1])
-                break
-            elif file_text[i] == "#@end {}".format(section):
-                section_tags[section] = (section_tags[section][0], i)
-                break
+    with open(sudoers_file) as f:
+        for i, line in enumerate(f):
+            # Only marker lines are of interest (this matters for big files).
+            if not line.startswith('#@'):
+                continue
+            line = line.rstrip('\n')
+            for section in sections:
+                if line == "#@start {}".format(section):
+                    section_tags[section] = (i, section_tags[section][1])
+                    break
+                elif is_end_marker(line, section):
+                    section_tags[section] = (section_tags[section][0], i)
+                    break
     # Verify that all of the sections have a beginning and an end.
     valid = True
     for section in sections: # This iteration is used to preserve order.
@@ -352,6 +386,52 @@ def validate(sudoers_file):
     # Success!
     return True
 
+def is_end_marker(line, section):
+    """
+    :param line: A line from the sudoers file.
+    :param section: The name of a section.
+    :returns: Whether the line is the end marker for the section, with or
+        without a checksum.
+    """
+    marker = "#@end {}".format(section)
+    return line == marker or line.startswith(marker + ' ')
+
+def section_digest(lines):
+    """
+    Computes the checksum of a section as written in its end marker.
+
+    :param lines: The rule lines of the section, in order.
+    :returns: The hex SHA-256 digest of the lines.
+    """
+    return hashlib.sha256('\n'.join(lines)).hexdigest()
+
+def check_sections(sudoers_file):
+    """
+    Compares each section of a sudoers file to the checksum in its end marker
+    to find out whether it was edited since Sudoers Manager last wrote it. This
+    method assumes that the file is a valid sudoers file as checked by
+    validate().
+
+    :param sudoers_file: The absolute path to the sudoers file.
+    :returns: A dictionary mapping section names to one of 'unchanged',
+        'modified', or 'unmarked' (the end marker has no checksum).
+    """
+    status = {}
+    lines  = {}
+    for section, number, line in iter_rules(sudoers_file, markers=True):
+        if not is_end_marker(line, section):
+            lines.setdefault(section, []).append(line)
+            continue
+        section_lines = lines.pop(section, [])
+        recorded = line.split(' sha256=', 1)
+        if len(recorded) < 2:
+            status[section] = 'unmarked'
+        elif recorded[1].strip() == section_digest(section_lines):
+            status[section] = 'unchanged'
+        else:
+            status[section] = 'modified'
+    return status
+
 def verify(sudoers_file):
     """
     Checks that a file is parseable as a valid sudoers file. Prints output
@@ -361,8 +441,12 @@ def verify(sudoers_file):
     """
     print("Checking file for syntax errors...")
     print("***")
-    # 'visudo' can check the validity of any proposed sudoers file.
-    result = subprocess.call(['/usr/sbin/visudo', '-c', '-f', sudoers_file])
+    # 'visudo' can check the validity of any proposed sudoers file. Its output
+    # is passed along through sys.stdout so that batch mode can collect it.
+    visudo = subprocess.Popen(['/usr/sbin/visudo', '-c', '-f', sudoers_file],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    sys.stdout.write(visudo.communicate()[0])
+    result = visudo.returncode
     print("***")
     if result:
         # Something went wrong. Exit with an error and leave the proposed file
@@ -405,51 +489,278 @@ def timestamp(sudoers_file):
     os.chown(temp_file, 0, 0)
     shutil.move(temp_file, sudoers_file)
 
-def get_rules_from_file(sudoers_file, verbose=False):
+def section_for(rule):
+    """
+    Determines which section a rule belongs in based on how it starts. Any rule
+    that doesn't begin with a section name is a user specification.
+
+    :param rule: A single sudoers rule.
+    :returns: The name of the section the rule belongs in.
+    """
+    rule = rule.strip()
+    for section in sections:
+        # Does the rule start with the current section?
+        if rule.startswith(section):
+            return section
+    # The rule didn't match any section. Put it in the user rules!
+    return 'User_Rule'
+
+# Rules belonging to an owner (see --state) are tagged with a trailing comment,
+# e.g. '%web ALL = (root) /usr/sbin/apachectl #@owner web'. sudo ignores it.
+owner_tag = '#@owner '
+
+def split_owner(rule):
+    """
+    Separates a rule from its owner tag, if it has one.
+
+    :param rule: A single sudoers rule.
+    :returns: A tuple of the rule without its tag and the owner's name (or None
+        if the rule isn't owned by anybody).
+    """
+    text, tag, owner = rule.rpartition(owner_tag)
+    if not tag or not owner.strip():
+        return rule.strip(), None
+    return text.strip(), owner.strip()
+
+def tag_owner(rule, owner):
+    """
+    Marks a rule as belonging to the given owner.
+
+    :param rule: A single sudoers rule without an owner tag.
+    :param owner: The name of the owner.
+    :returns: The tagged rule.
+    """
+    return '{} {}{}'.format(rule, owner_tag, owner)
+
+def canonical_form(rule):
+    """
+    :param rule: A single sudoers rule.
+    :returns: The rule without its owner tag or surrounding whitespace, which is
+        what rules are compared by.
+    """
+    if owner_tag in rule:
+        return split_owner(rule)[0]
+    return rule.strip()
+
+def principal_for(rule):
+    """
+    :param rule: A single sudoers rule without an owner tag.
+    :returns: The user or group a user specification is for, the name of an
+        alias, or the user a 'Defaults:' rule is bound to. Otherwise None.
+    """
+    section = section_for(rule)
+    if section == 'User_Rule':
+        words = rule.split(None, 1)
+    elif section == 'Defaults':
+        if not rule.startswith('Defaults:'):
+            return None
+        words = rule[len('Defaults:'):].split(None, 1)
+    else:
+        words = rule.partition('=')[0].split()[1:]
+    return words[0] if words else None
+
+class RuleList(object):
+    """
+    The rules in a single section, in order, exactly as they appear in the file.
+    The canonical form of each rule is also kept in a set, so checking whether a
+    rule is in the section doesn't have to search through it. (For most rules
+    the canonical form is the rule itself, so this costs no extra strings.)
+    Appending a rule that's already there (or an empty one) does nothing, which
+    keeps the section free of duplicates.
+    """
+    __slots__ = ('rules', 'keys')
+
+    def __init__(self, rules=()):
+        """
+        :param rules: Any rules to start out with.
+        """
+        self.rules = []
+        self.keys  = set()
+        # This is how whole sections are read in, so it's worth doing without
+        # a call to append() for every rule.
+        add = self.keys.add
+        for rule in rules:
+            key = split_owner(rule)[0] if owner_tag in rule else rule.strip()
+            if key and key not in self.keys:
+                add(key)
+                self.rules.append(rule)
+
+    def append(self, rule):
+        """
+        Adds a rule to the end of the section if it isn't already there.
+
+        :param rule: The rule to add.
+        :returns: True if the rule was added, otherwise False.
+        """
+        key = canonical_form(rule)
+        if not key or key in self.keys:
+            return False
+        self.keys.add(key)
+        self.rules.append(rule)
+        return True
+
+    def copy(self):
+        """
+        :returns: A new RuleList with the same rules.
+        """
+        duplicate = RuleList()
+        duplicate.rules = list(self.rules)
+        duplicate.keys  = set(self.keys)
+        return duplicate
+
+    def __contains__(self, rule):
+        return canonical_form(rule) in self.keys
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __repr__(self):
+        return repr(self.rules)
+
+def empty_rules():
+    """
+    :returns: A dictionary mapping each section name to an empty RuleList.
+    """
+    return {section: RuleList() for section in sections}
+
+def get_rules_from_file(sudoers_file, verbose=False, cache=None):
     """
     Pulls rules out of a sudoers file and sorts them into their appropriate
     sections. This method assumes that the file is a valid sudoers file as
     checked by validate().
 
     :param sudoers_file: The absolute path to the sudoers file.
-    :returns: A dictionary mapping section names to lists of rules that belong
-        in that section.
+    :param verbose: Whether to print out each line as it is read.
+    :param cache: An optional dictionary of sections parsed by an earlier call.
+        A section whose contents still have the same checksum is taken from the
+        cache rather than parsed again. The cache is updated to hold the
+        sections from this file.
+    :returns: A dictionary mapping section names to the RuleList of rules that
+        belong in that section.
     """
-    rules = {section: [] for section in sections}
-    # To make things easier, just pull all the lines from the file into a list.
-    lines = []
-    with open(sudoers_file) as f:
-        lines = f.read().splitlines()
-    # Now we iterate over the list by section. We're already guaranteed that the
-    # file exists in the proper format.
-    index = 0
+    rules  = empty_rules()
+    parsed = {}
+    # Gather up the lines of each section.
+    lines = collections.defaultdict(list)
+    for section, number, line in iter_rules(sudoers_file, verbose=verbose):
+        lines[section].append(line)
     for section in sections:
-        line = lines[index]
-        # Search for the section we need.
-        while (not line.startswith('#@start {}'.format(section))):
-            if verbose:
-                print("line: {}".format(line))
-            index += 1
-            line = lines[index]
-        # (Need to iterate over the '#@start' line.)
-        index += 1
-        line = lines[index]
-        # Until we get to the end, add things to the rules list.
-        while (not line.startswith('#@end {}'.format(section))):
-            # Is the line a comment?
-            if line and not line.strip().startswith('#'):
-                # No, so add it to the rules.
+        # Only parse the rules if we haven't already seen this exact section.
+        key = (section, section_digest(lines[section]))
+        if cache is not None and key in cache:
+            parsed[key] = cache[key]
+        else:
+            parsed[key] = RuleList(lines[section])
+        # The cached copy has to stay as it is, since the rules get changed.
+        rules[section] = parsed[key].copy() if cache is not None else parsed[key]
+    if cache is not None:
+        cache.clear()
+        cache.update(parsed)
+    if verbose:
+        print("rules: {}".format(rules))
+    return rules
+
+def iter_rules(sudoers_file, markers=False, verbose=False):
+    """
+    Reads the rule lines out of a sudoers file one at a time, without holding
+    the file in memory. This is the one place the sections of a file are picked
+    apart; everything else that reads a conforming file builds on it. Duplicate
+    rules are not removed. This method assumes that the file is a valid sudoers
+    file as checked by validate().
+
+    :param sudoers_file: The absolute path to the sudoers file.
+    :param markers: Whether to also hand back the '#@end' marker of each
+        section (after the section's rules), e.g. to check its checksum.
+    :param verbose: Whether to print out each line as it is read.
+    :returns: A generator of (section name, line number, line) tuples.
+    """
+    section = None
+    with open(sudoers_file) as f:
+        for number, line in enumerate(f, 1):
+            line = line.rstrip('\n')
+            if section is None:
+                # Look for the start of the next section.
+                if line.startswith('#@start ') and len(line.split()) > 1:
+                    section = line.split()[1]
+                elif verbose:
+                    print("line: {}".format(line))
+            elif line.strip()[:1] not in ('', '#'):
+                # (Checked first, since nearly every line in a section is a rule.)
                 if verbose:
                     print("rule: {}".format(line))
-                rules[section].append(line)
+                yield section, number, line
+            elif is_end_marker(line, section):
+                if markers:
+                    yield section, number, line
+                section = None
             elif verbose:
                 # It's a comment. Ignore it!
                 print("cmnt: {}".format(line))
-            index += 1
-            line = lines[index]
-    if verbose:
-        print("rules: {}".format(rules))
-    return rules
+
+def export_ndjson(sudoers_file, out):
+    """
+    Writes out every rule in a sudoers file as newline-delimited JSON, one
+    object per rule, e.g.:
+
+        {"section": "User_Rule", "rule": "%web ALL = (root) WEB", "line": 97, "owner": "web"}
+
+    Rules are written as they are read, so this starts right away and doesn't
+    need to hold the file in memory.
+
+    Every rule has to be valid UTF-8, since that's what JSON holds; if one
+    isn't, this exits.
+
+    :param sudoers_file: The absolute path to the sudoers file.
+    :param out: The file object to write to.
+    """
+    # Filling in a template keeps the fields in order, and is much quicker than
+    # having json build each object.
+    record = '{{"section": {}, "rule": {}, "line": {}, "owner": {}}}\n'
+    encode = json.JSONEncoder().encode
+    for section, number, line in iter_rules(sudoers_file):
+        rule, owner = split_owner(line)
+        try:
+            out.write(record.format(encode(section), encode(rule), number, encode(owner)))
+        except UnicodeDecodeError:
+            # Guessing at the encoding could quietly change a user name when
+            # the rule is imported again.
+            print("Unable to export line {}: it isn't valid UTF-8.".format(number))
+            sys.exit(3)
+
+def read_ndjson(stream):
+    """
+    Reads rules from newline-delimited JSON as written by export_ndjson(). Only
+    the 'rule' field is required; the section is worked out from the rule, and
+    the owner (if any) is kept. Rules are handed back as they are read. If a
+    record can't be used, this exits.
+
+    :param stream: The file object to read from.
+    :returns: A generator of rules (with their owner tags).
+    """
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            rule   = record['rule'].encode('utf-8')
+            owner  = record.get('owner')
+            # A line break would let the rule spill out of its section.
+            if '\n' in rule or '\r' in rule:
+                raise ValueError("the rule can't contain a line break: {!r}".format(rule))
+            if owner is not None:
+                if not valid_owner(owner):
+                    raise ValueError("the owner must be a single word: {!r}".format(owner))
+                owner = owner.encode('utf-8')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            print("Unable to import record {}: {}".format(number, e))
+            sys.exit(3)
+        if owner:
+            yield tag_owner(rule.strip(), owner)
+        else:
+            yield rule
 
 def get_rules_from_nonconforming_file(sudoers_file):
     """
@@ -458,10 +769,10 @@ def get_rules_from_nonconforming_file(sudoers_file):
     (i.e. it passes `visudo -c`).
 
     :param sudoers_file: The absolute path to a supposed sudoers file.
-    :returns: A dictionary mapping section names to lists of rules that belong
-        in that section.
+    :returns: A dictionary mapping section names to the RuleList of rules that
+        belong in that section.
     """
-    rules = {section: [] for section in sections}
+    rules = empty_rules()
     # Read in the existing file to a list.
     lines = []
     with open(sudoers_file) as f:
@@ -474,18 +785,7 @@ def get_rules_from_nonconforming_file(sudoers_file):
             raw_rules.append(line)
     # Take all of the rules we've found and sort them into their sections.
     for rule in raw_rules:
-        # Check each possible section and see if the line starts with it.
-        added = False
-        for section in sections:
-            # Does the line start with the current section?
-            if rule.strip().startswith(section):
-                # Add it in and mark the rule as 'added'.
-                rules[section].append(rule)
-                added = True
-                break
-        if not added:
-            # The rule wasn't added. Put it in the user rules!
-            rules['User_Rule'].append(rule)
+        rules[section_for(rule)].append(rule)
     # Give back the results!
     return rules
 
@@ -517,6 +817,796 @@ def backup(sudoers_file):
         # Otherwise make a copy in the regular backup location.
         shutil.copy2(sudoers_file, backup)
 
+def load_rules(sudoers_file, args, interactive=True, cache=None):
+    """
+    Reads in the existing rules for a run and decides whether the sudoers file
+    needs to be rebuilt from the template. Unless the arguments say otherwise,
+    this may prompt the user for permission to create or migrate the file. If
+    the file can't be used, this exits.
+
+    :param sudoers_file: The absolute path to the sudoers file.
+    :param args: The parsed command-line arguments.
+    :param interactive: Whether the user may be prompted. If not, any question
+        that would have been asked is answered 'no'.
+    :param cache: An optional cache of parsed sections for get_rules_from_file().
+    :returns: A tuple of the dictionary mapping section names to RuleLists and
+        a boolean for whether to build the file from the template.
+    """
+    # This is the default, blank rules dict.
+    rules = empty_rules()
+    # Will we be creating from the template?
+    create_from_template = args.build_templated
+    # Does the file exist?
+    if os.path.isfile(sudoers_file):
+        # Yes, it exists. Do we care to save it?
+        if args.discard:
+            # Nope!
+            create_from_template = True
+        else:
+            # Let's save it. Does it conform to our specifications?
+            if validate(sudoers_file):
+                # Yes, it conforms. Should we replace the existing rules?
+                if not args.replace_rules:
+                    # No, don't replace them. Let's pull the existing rules from it.
+                    rules = get_rules_from_file(sudoers_file, args.verbose, cache)
+            else:
+                # The file is not a conforming sudoers file for Sudoers Manager.
+                # Is the file even a system-recognized sudoers file?
+                if verify(sudoers_file):
+                    # Yes it is. Let's see if we should try to migrate.
+                    if args.migrate or (interactive and prompt_user("The sudoers file doesn't conform. Would you like to migrate your existing rules to a new file?")):
+                        # Pull out the rules that are already in the file.
+                        rules = get_rules_from_nonconforming_file(sudoers_file)
+                        create_from_template = True
+                    else:
+                        # The user didn't want to migrate, so let's quit.
+                        print("The file that exists does not conform to Sudoers Manager specifications: {}".format(sudoers_file))
+                        sys.exit(4)
+                else:
+                    # The file is not valid, which is an error.
+                    print("No valid sudoers file exists at: {}".format(sudoers_file))
+                    sys.exit(3)
+    else:
+        # The file does not exist. Should we create a new file from template?
+        if args.create or (interactive and prompt_user("No sudoers file exists. Would you like to create one from the template?")):
+            # Create the file from scratch.
+            create_from_template = True
+        else:
+            # The user didn't want to create the file from scratch, so quit.
+            print("No file exists and one is not going to be created at: {}".format(sudoers_file))
+            sys.exit(4)
+    return rules, create_from_template
+
+def apply_changes(rules, additions, deletions):
+    """
+    Adds and removes rules, then puts every section into its proper order.
+
+    :param rules: A dictionary mapping section names to RuleLists.
+    :param additions: The rules to be added. Rules that are already present
+        (ignoring owner tags) are not added again.
+    :param deletions: The rules to be removed (if they exist).
+    :returns: The updated dictionary of rules.
+    """
+    # Add the user-specified rules to the rules dict.
+    for rule in additions:
+        rule = rule.strip()
+        rules[section_for(rule)].append(rule)
+    # Remove rules specified for deletion (whoever owns them).
+    deletions = set(rule.strip() for rule in deletions)
+    for section in sections:
+        if any(rule in rules[section] for rule in deletions):
+            rules[section] = RuleList(x for x in rules[section] if canonical_form(x) not in deletions)
+    # Organize the defaults specification rules so that any rules beginning with
+    # 'Defaults:' will be pushed to the end of the list. (This goes by the text
+    # so continuation lines stay with the line they continue.)
+    defaults_rules      = [x for x in rules['Defaults'] if not x.strip().startswith('Defaults:')]
+    user_defaults_rules = [x for x in rules['Defaults'] if x.strip().startswith('Defaults:')]
+    rules['Defaults'] = RuleList(defaults_rules + user_defaults_rules)
+    # Organize the user specification rules so that any ALL rules will be pushed
+    # to the end of the list.
+    user_spec_rules = [x for x in rules['User_Rule'] if not x.strip().startswith('ALL')]
+    all_rules       = [x for x in rules['User_Rule'] if x.strip().startswith('ALL')]
+    rules['User_Rule'] = RuleList(user_spec_rules + all_rules)
+    return rules
+
+def render(rules, sudoers_file, create_from_template):
+    """
+    Writes the rules out to a temporary copy of the sudoers file (or to a fresh
+    template) and commits it into place.
+
+    :param rules: A dictionary mapping section names to RuleLists.
+    :param sudoers_file: The absolute path to the sudoers file.
+    :param create_from_template: Whether to discard the existing file and build
+        a new one from the template.
+    """
+    # Should we create a new file from the template?
+    if create_from_template:
+        # Build the new file.
+        handle, temp_file = tempfile.mkstemp()
+        build_clean_from_template(temp_file)
+    else:
+        # Copy the original to a temp file.
+        handle, temp_file = tempfile.mkstemp()
+        shutil.copy(sudoers_file, temp_file)
+    # Write the changes to the temp file.
+    write_rules(rules, temp_file)
+    os.close(handle)
+    # Commit the changes from the temp file to the sudoers file.
+    commit(temp_file, sudoers_file)
+
+def section_hashes(rules):
+    """
+    Computes a digest of each section's rules. Two sets of rules with matching
+    digests would produce identical sections in the sudoers file.
+
+    :param rules: A dictionary mapping section names to RuleLists.
+    :returns: A dictionary mapping section names to hex digests.
+    """
+    return {section: section_digest(rules[section]) for section in sections}
+
+def load_state(state_file):
+    """
+    Reads a desired-state file. This is a JSON object naming its owner and
+    listing every rule that owner wants in the sudoers file, e.g.:
+
+        {"owner": "web", "rules": ["%web ALL = (root) /usr/sbin/apachectl"]}
+
+    If the file can't be used, this exits.
+
+    :param state_file: The path to the desired-state file.
+    :returns: A tuple of the owner's name and the list of rules.
+    """
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+        owner = state['owner']
+        rules = state['rules']
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        print("Unable to read the desired-state file {}: {}".format(state_file, e))
+        sys.exit(3)
+    if not isinstance(rules, list) or not all(isinstance(rule, basestring) for rule in rules):
+        print("The rules in {} must be a list of strings.".format(state_file))
+        sys.exit(3)
+    if not valid_owner(owner):
+        print("The owner in {} must be a single word: {!r}".format(state_file, owner))
+        sys.exit(3)
+    # JSON gives back unicode, but the rest of the rules are plain strings.
+    rules = [rule.encode('utf-8').strip() for rule in rules]
+    # A line break would let a rule spill out of its section.
+    for rule in rules:
+        if '\n' in rule or '\r' in rule:
+            print("The rules in {} can't contain line breaks: {!r}".format(state_file, rule))
+            sys.exit(3)
+    return owner.encode('utf-8'), [rule for rule in rules if rule]
+
+def valid_owner(owner):
+    """
+    :param owner: A proposed owner name.
+    :returns: Whether the name can be used in an owner tag, i.e. whether it is
+        a single word that split_owner() will read back unchanged.
+    """
+    return isinstance(owner, basestring) and len(owner.split()) == 1 and owner.strip() == owner
+
+def converge_owner(rules, owner, desired):
+    """
+    Makes the rules tagged with the given owner match the owner's desired rules
+    exactly, touching as little as possible. Rules that are untagged or belong
+    to anybody else are left alone. If one of them is a rule the owner wants,
+    it counts as already being there (so it isn't duplicated), but it stays
+    untagged and is never removed on the owner's behalf.
+
+    :param rules: A dictionary mapping section names to RuleLists. This is
+        modified in place.
+    :param owner: The name of the owner.
+    :param desired: The list of rules the owner wants.
+    :returns: A tuple of the number of rules added and the number removed.
+    """
+    desired = [canonical_form(rule) for rule in desired]
+    wanted  = set(desired)
+    present = set()
+    added   = 0
+    removed = 0
+    for section in sections:
+        kept = RuleList()
+        for rule in rules[section]:
+            text, tag = split_owner(rule)
+            if tag == owner and text not in wanted:
+                # It's one of ours, but it isn't wanted anymore.
+                removed += 1
+                continue
+            if tag not in (None, owner) and text in wanted:
+                print("Rule is already owned by '{}': {}".format(tag, text))
+            if text in wanted:
+                present.add(text)
+            kept.append(rule)
+        rules[section] = kept
+    # Anything that's still missing gets added.
+    for text in desired:
+        if text not in present:
+            present.add(text)
+            rules[section_for(text)].append(tag_owner(text, owner))
+            added += 1
+    return added, removed
+
+def lock(sudoers_file):
+    """
+    Takes an exclusive lock on the directory holding the sudoers file so that
+    separate runs (e.g. one per desired-state owner) don't overwrite each
+    other's changes. Locking the directory rather than a lock file means nothing
+    is left behind in /etc (or in an image root). This blocks until any other
+    run is done.
+
+    :param sudoers_file: The absolute path to the sudoers file.
+    :returns: The open file descriptor of the directory. Closing it releases
+        the lock.
+    """
+    lock_fd = os.open(os.path.dirname(sudoers_file), os.O_RDONLY)
+    # Don't let visudo (or anything else we run) hold on to the lock.
+    fcntl.fcntl(lock_fd, fcntl.F_SETFD, fcntl.fcntl(lock_fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+    except:
+        os.close(lock_fd)
+        raise
+    return lock_fd
+
+# The schema for the rule store. Each rule is kept in its canonical form (without
+# its owner tag), and every change is recorded in the history table.
+store_schema = '''
+CREATE TABLE IF NOT EXISTS rules (
+    id        INTEGER PRIMARY KEY,
+    section   TEXT NOT NULL,
+    canonical TEXT NOT NULL,
+    owner     TEXT,
+    principal TEXT,
+    created   TEXT NOT NULL,
+    expires   TEXT,
+    UNIQUE (section, canonical)
+);
+CREATE INDEX IF NOT EXISTS rules_principal ON rules (principal);
+CREATE INDEX IF NOT EXISTS rules_section ON rules (section, id);
+CREATE TABLE IF NOT EXISTS history (
+    id        INTEGER PRIMARY KEY,
+    at        TEXT NOT NULL,
+    action    TEXT NOT NULL,
+    section   TEXT NOT NULL,
+    canonical TEXT NOT NULL,
+    owner     TEXT
+);
+'''
+
+def now():
+    """
+    :returns: The current local time as stored in the rule store.
+    """
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def expiry(value):
+    """
+    Checks an expiration time given on the command line.
+
+    :param value: A date ('2026-12-31') or date and time ('2026-12-31 17:00:00')
+        in the future.
+    :returns: The expiration time in the form stored in the rule store.
+    """
+    for form in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            expires = datetime.datetime.strptime(value, form).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            continue
+        # (The stored form sorts the same way as the times it stands for.)
+        if expires <= now():
+            raise argparse.ArgumentTypeError("already passed: '{}'".format(value))
+        return expires
+    raise argparse.ArgumentTypeError("not a date or date and time: '{}'".format(value))
+
+def open_store(store_file):
+    """
+    Opens the rule store, creating it if it doesn't exist yet. If sqlite3 isn't
+    available, this exits.
+
+    :param store_file: The path to the SQLite database.
+    :returns: The database connection.
+    """
+    if sqlite3 is None:
+        print("The rule store requires the sqlite3 module, which is not available.")
+        sys.exit(3)
+    store = sqlite3.connect(store_file)
+    # Hand back plain strings rather than unicode, like the rest of the rules.
+    store.text_factory = str
+    store.executescript(store_schema)
+    return store
+
+def load_store_rules(store, sudoers_file, args):
+    """
+    Reads the rules for a run from the rule store. Expired rules are removed
+    from the store first. This doesn't commit the transaction. If the store
+    has never been used but the sudoers file has rules, this exits rather than
+    throw those rules away, unless they are being imported or replaced.
+
+    :param store: The database connection from open_store().
+    :param sudoers_file: The absolute path to the sudoers file, which is only
+        read if the rules in it are being imported.
+    :param args: The parsed command-line arguments.
+    :returns: A dictionary mapping section names to RuleLists.
+    """
+    used = store.execute('SELECT EXISTS (SELECT 1 FROM rules) OR EXISTS (SELECT 1 FROM history)').fetchone()[0]
+    if not used and not args.store_import and not args.replace_rules and os.path.isfile(sudoers_file):
+        existing = get_rules_from_nonconforming_file(sudoers_file)
+        if any(existing[section] for section in sections):
+            print("The rule store is empty, but the sudoers file has rules: {}".format(sudoers_file))
+            print("Use --store-import to keep them or --replace-rules to discard them.")
+            sys.exit(4)
+    expired = store.execute('SELECT section, canonical, owner FROM rules WHERE expires <= ?', (now(),)).fetchall()
+    if expired:
+        store.executemany("INSERT INTO history (at, action, section, canonical, owner) VALUES (?, 'expire', ?, ?, ?)",
+                          [(now(),) + row for row in expired])
+        store.execute('DELETE FROM rules WHERE expires <= ?', (now(),))
+        print("Store: {} expired.".format(len(expired)))
+    rules = empty_rules()
+    if not args.replace_rules:
+        for section, canonical, owner in store.execute('SELECT section, canonical, owner FROM rules ORDER BY section, id'):
+            rules[section].append(tag_owner(canonical, owner) if owner else canonical)
+    if args.store_import:
+        # Pull in whatever is in the sudoers file now, whether it conforms or not.
+        if not os.path.isfile(sudoers_file) or not verify(sudoers_file):
+            print("No valid sudoers file exists to import from at: {}".format(sudoers_file))
+            sys.exit(3)
+        imported = get_rules_from_nonconforming_file(sudoers_file)
+        for section in sections:
+            for rule in imported[section]:
+                rules[section].append(rule)
+    return rules
+
+def save_store_rules(store, rules, expiring=(), expires=None):
+    """
+    Brings the rule store in line with the given rules using as few statements
+    as possible. This doesn't commit the transaction.
+
+    :param store: The database connection from open_store().
+    :param rules: A dictionary mapping section names to RuleLists.
+    :param expiring: The rules that should be given the expiration time.
+    :param expires: The expiration time, as returned by expiry(), if any.
+    """
+    at = now()
+    existing = {}
+    for row in store.execute('SELECT section, canonical, owner FROM rules'):
+        existing[row[:2]] = row[2]
+    wanted = set()
+    added   = []
+    updated = []
+    # Go through the rules in order so new ones are stored in that order.
+    for section in sections:
+        for rule in rules[section]:
+            text, owner = split_owner(rule)
+            key = (section, text)
+            wanted.add(key)
+            if key not in existing:
+                added.append((section, text, owner, principal_for(text), at))
+            elif existing[key] != owner:
+                updated.append((owner, section, text))
+    removed = [key + (owner,) for key, owner in existing.iteritems() if key not in wanted]
+    store.executemany('DELETE FROM rules WHERE section = ? AND canonical = ?', [row[:2] for row in removed])
+    store.executemany('INSERT INTO rules (section, canonical, owner, principal, created) VALUES (?, ?, ?, ?, ?)', added)
+    store.executemany('UPDATE rules SET owner = ? WHERE section = ? AND canonical = ?', updated)
+    # Keep track of what happened.
+    history = [(at, 'remove') + row for row in removed]
+    history += [(at, 'add') + row[:3] for row in added]
+    history += [(at, 'update', row[1], row[2], row[0]) for row in updated]
+    store.executemany('INSERT INTO history (at, action, section, canonical, owner) VALUES (?, ?, ?, ?, ?)', history)
+    if expires:
+        expiring = [canonical_form(rule) for rule in expiring]
+        store.executemany('UPDATE rules SET expires = ? WHERE section = ? AND canonical = ?',
+                          [(expires, section_for(rule), rule) for rule in expiring])
+    print("Store: {} added, {} removed, {} updated.".format(len(added), len(removed), len(updated)))
+
+def reconcile(sudoers_file, args, only_on_drift=False, interactive=True, cache=None):
+    """
+    Runs the full pipeline once: reads the existing rules, applies the requested
+    changes, and commits the result.
+
+    :param sudoers_file: The absolute path to the sudoers file.
+    :param args: The parsed command-line arguments.
+    :param only_on_drift: If True, the file is only rewritten when the result
+        would differ from what is already in it.
+    :param interactive: Whether the user may be prompted.
+    :param cache: An optional cache of parsed sections for get_rules_from_file().
+    :returns: True if the sudoers file was rewritten, otherwise False.
+    """
+    # Read the desired-state files up front so a bad one stops us early.
+    states = [load_state(state_file) for state_file in args.state]
+    store = open_store(args.store) if args.store else None
+    lock_fd = lock(sudoers_file)
+    try:
+        current = None
+        if store is not None:
+            # The store is the source of truth, so the file is always built
+            # from the template.
+            rules = load_store_rules(store, sudoers_file, args)
+            create_from_template = True
+            if only_on_drift and os.path.isfile(sudoers_file) and validate(sudoers_file):
+                current = section_hashes(get_rules_from_file(sudoers_file, cache=cache))
+        else:
+            rules, create_from_template = load_rules(sudoers_file, args, interactive, cache)
+            # Take note of what's in the file now so we can tell whether it drifted.
+            if only_on_drift and not create_from_template:
+                if args.replace_rules:
+                    # The rules weren't read in, so we have to go get them.
+                    current = section_hashes(get_rules_from_file(sudoers_file, cache=cache))
+                else:
+                    current = section_hashes(rules)
+        # Bring each owner's rules in line with its desired state.
+        for owner, desired in states:
+            added, removed = converge_owner(rules, owner, desired)
+            print("Owner '{}': {} added, {} removed.".format(owner, added, removed))
+        additions = args.rules
+        expiring  = args.rules
+        if store is not None and args.expires and args.expires <= now():
+            # The rules given on the command line have expired since we started
+            # (e.g. in --watch). They were just taken out of the store, so don't
+            # put them right back.
+            additions = []
+            expiring  = []
+        if args.import_format == 'ndjson':
+            # Feed the imported rules straight in as they're read.
+            additions = itertools.chain(additions, read_ndjson(sys.stdin))
+        rules = apply_changes(rules, additions, args.delete)
+        if store is not None:
+            save_store_rules(store, rules, expiring, args.expires)
+        if current is not None and section_hashes(rules) == current:
+            # Nothing would change, so leave the file alone.
+            print("No changes needed.")
+            changed = False
+        else:
+            render(rules, sudoers_file, create_from_template)
+            changed = True
+        # The store is only updated once the file has been committed, so the
+        # two can't disagree if the new file is rejected.
+        if store is not None:
+            store.commit()
+        return changed
+    finally:
+        os.close(lock_fd)
+        if store is not None:
+            store.close()
+
+# The inotify(7) events that indicate a file in a watched directory was written,
+# created, deleted, or moved in or out. Watching the directory (rather than the
+# file) means we still see the new file after commit() moves it into place.
+inotify_mask = 0x00000008 | 0x00000040 | 0x00000080 | 0x00000100 | 0x00000200
+
+def load_inotify():
+    """
+    Loads the C library if it provides inotify (i.e. on Linux).
+
+    :returns: The C library, or None if inotify is not available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+def open_inotify(libc, paths):
+    """
+    Sets up an inotify instance watching the directories of the given paths.
+
+    :param libc: The C library as returned by load_inotify().
+    :param paths: The absolute paths of the files to watch.
+    :returns: A tuple of the inotify file descriptor and a dictionary mapping
+        watch descriptors to the set of file names watched within them.
+    """
+    fd = libc.inotify_init()
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    watched = {}
+    for path in paths:
+        directory, name = os.path.split(path)
+        wd = libc.inotify_add_watch(fd, directory, inotify_mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, os.strerror(err), directory)
+        watched.setdefault(wd, set()).add(name)
+    return fd, watched
+
+def inotify_changes(fd, watched, settle=0.5):
+    """
+    Blocks until one of the watched files changes, then yields. Events that
+    arrive in quick succession (such as the move and timestamp from a single
+    commit) are collapsed into one change.
+
+    :param fd: The inotify file descriptor from open_inotify().
+    :param watched: The watch descriptor mapping from open_inotify().
+    :param settle: How many seconds to wait for more events before yielding.
+    """
+    try:
+        while True:
+            changed = False
+            ready = select.select([fd], [], [])[0]
+            while ready:
+                data = os.read(fd, 65536)
+                offset = 0
+                while offset < len(data):
+                    # Each event is a 'struct inotify_event' followed by a
+                    # null-padded file name.
+                    wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                    name = data[offset + 16:offset + 16 + length].rstrip('\0')
+                    offset += 16 + length
+                    if name in watched.get(wd, ()):
+                        changed = True
+                ready = select.select([fd], [], [], settle)[0]
+            if changed:
+                yield
+    finally:
+        os.close(fd)
+
+def poll_changes(paths, interval):
+    """
+    Checks the modification time, size, and inode of each file every so often
+    and yields whenever any of them has changed.
+
+    :param paths: The absolute paths of the files to watch.
+    :param interval: How many seconds to wait between checks.
+    """
+    def snapshot():
+        stats = []
+        for path in paths:
+            try:
+                info = os.stat(path)
+                stats.append((info.st_mtime, info.st_size, info.st_ino))
+            except OSError:
+                stats.append(None)
+        return stats
+    previous = snapshot()
+    while True:
+        time.sleep(interval)
+        current = snapshot()
+        if current != previous:
+            previous = current
+            yield
+
+def watch_for_changes(paths, interval):
+    """
+    Watches the given files for changes, using inotify where it's available and
+    falling back to polling otherwise.
+
+    :param paths: The absolute paths of the files to watch.
+    :param interval: How many seconds to wait between checks when polling.
+    :returns: An iterator that yields each time one of the files changes.
+    """
+    libc = load_inotify()
+    if libc:
+        try:
+            fd, watched = open_inotify(libc, paths)
+        except OSError as e:
+            print("Unable to use inotify ({}). Polling instead.".format(e))
+        else:
+            return inotify_changes(fd, watched)
+    return poll_changes(paths, interval)
+
+def watch(sudoers_file, args):
+    """
+    Runs until interrupted, reconciling the sudoers file whenever it changes.
+    The file is only rewritten if its sections have drifted from the requested
+    rules, so an idle host does no work at all. If every section still matches
+    the checksum in its end marker and the desired-state files haven't changed,
+    the file isn't even parsed. (This only holds within a single watch; every
+    other run parses all of the sections.)
+
+    :param sudoers_file: The absolute path to the sudoers file.
+    :param args: The parsed command-line arguments.
+    """
+    # Discarding or rebuilding the file (or importing rules) only makes sense
+    # for the first run. After that, doing it again would count as drift every
+    # single time.
+    args = argparse.Namespace(**vars(args))
+    args.discard = False
+    args.build_templated = False
+    args.store_import = False
+    args.import_format = None
+    # Watch the desired-state files and the rule store too, since they can
+    # change the result.
+    paths = [sudoers_file] + [os.path.abspath(state_file) for state_file in args.state]
+    if args.store:
+        paths.append(os.path.abspath(args.store))
+    print("Watching for changes to: {}".format(', '.join(paths)))
+    # The first run has just finished, so we start out converged.
+    cache     = {}
+    states    = [file_digest(path) for path in paths[1:]]
+    converged = True
+    for _ in watch_for_changes(paths, args.interval):
+        # Has anything we care about actually changed since the last pass?
+        current_states = [file_digest(path) for path in paths[1:]]
+        if converged and current_states == states and os.path.isfile(sudoers_file):
+            status = check_sections(sudoers_file)
+            if all(status.get(section) == 'unchanged' for section in sections):
+                continue
+        states = current_states
+        try:
+            if reconcile(sudoers_file, args, only_on_drift=True, interactive=False, cache=cache):
+                print("Drift corrected.")
+            elif any(status != 'unchanged' for status in check_sections(sudoers_file).values()):
+                # Nothing drifted, but a section's checksum is missing (e.g. the
+                # file predates them) or stale (e.g. a rule was added by hand
+                # that doesn't conflict with anything), so every change would go
+                # through the whole pipeline. Write the checksums once to avoid
+                # that.
+                reconcile(sudoers_file, args, interactive=False, cache=cache)
+                print("Section checksums written.")
+            converged = True
+        except SystemExit:
+            # Don't stop watching just because one pass failed.
+            print("Unable to reconcile the sudoers file. Waiting for the next change.")
+            converged = False
+
+def file_digest(path):
+    """
+    :param path: The path to a file.
+    :returns: The hex SHA-256 digest of the file's contents, or None if it
+        can't be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except IOError:
+        return None
+
+def audit(sudoers_file):
+    """
+    Reports which sections of the sudoers file were edited outside of Sudoers
+    Manager since it last wrote them.
+
+    :param sudoers_file: The absolute path to the sudoers file.
+    :returns: The exit status: 0 if no section was edited, 5 if any was, or 3
+        if the file can't be checked.
+    """
+    if not os.path.isfile(sudoers_file) or not validate(sudoers_file):
+        print("No valid sudoers file exists at: {}".format(sudoers_file))
+        return 3
+    status = check_sections(sudoers_file)
+    result = 0
+    for section in sections:
+        if status[section] == 'modified':
+            print("Section '{}' was edited outside of Sudoers Manager.".format(section))
+            result = 5
+        elif status[section] == 'unmarked':
+            print("Section '{}' has no checksum to check against.".format(section))
+    if not result:
+        print("No sections were edited outside of Sudoers Manager.")
+    return result
+
+def read_root_list(root_list):
+    """
+    Reads a list of root directories (e.g. image build roots or chroots), one
+    per line. Blank lines and lines starting with '#' are skipped.
+
+    :param root_list: The path to the list.
+    :returns: The list of root directories.
+    """
+    try:
+        with open(root_list) as f:
+            lines = f.read().splitlines()
+    except IOError as e:
+        print("Unable to read the root list {}: {}".format(root_list, e))
+        sys.exit(3)
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith('#')]
+
+class TargetOutput(object):
+    """
+    Stands in for sys.stdout during a batch. Whatever a worker thread prints
+    while it's working on a target is held back, so each target's output can be
+    printed all together instead of mixed in with everyone else's. Anything
+    printed outside of a target goes straight through.
+    """
+
+    def __init__(self, stream):
+        """
+        :param stream: The real stdout.
+        """
+        self.stream = stream
+        self.local  = threading.local()
+
+    def capture(self):
+        """
+        Starts holding back whatever the current thread prints.
+        """
+        self.local.buffer = []
+
+    def release(self):
+        """
+        Stops holding back the current thread's output.
+
+        :returns: Everything the current thread printed since capture().
+        """
+        buffer = getattr(self.local, 'buffer', None) or []
+        self.local.buffer = None
+        return ''.join(buffer)
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            self.stream.write(text)
+        else:
+            buffer.append(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+def run_target(sudoers_file, args):
+    """
+    Makes the requested changes to (or audits) a single sudoers file in batch
+    mode. Nobody can be prompted, and exiting only ends this target.
+
+    :param sudoers_file: The absolute path to the sudoers file.
+    :param args: The parsed command-line arguments.
+    :returns: The exit status for this target.
+    """
+    try:
+        if args.audit:
+            return audit(sudoers_file)
+        reconcile(sudoers_file, args, only_on_drift=bool(args.state), interactive=False)
+        return 0
+    except SystemExit as e:
+        return e.code
+    except Exception as e:
+        # Whatever went wrong, it only stops this target; the rest of the batch
+        # (and the output of targets that are already done) carries on.
+        print("Unable to update {}: {}: {}".format(sudoers_file, type(e).__name__, e))
+        return 3
+
+def run_batch(targets, args):
+    """
+    Runs every target at the same time (up to --jobs at once) and reports how
+    each of them went. Most of the time for each target is spent waiting on
+    visudo, so the batch takes about as long as the slowest target. Each
+    target's output is held until the end and printed along with its result.
+
+    :param targets: The absolute paths to the sudoers files.
+    :param args: The parsed command-line arguments.
+    :returns: The exit status for the batch: 0 if every target succeeded,
+        1 if the batch was interrupted, otherwise the highest exit status of
+        any target.
+    """
+    output = TargetOutput(sys.stdout)
+
+    def run(target):
+        output.capture()
+        try:
+            result = run_target(target, args)
+        finally:
+            printed = output.release()
+        return result, printed
+
+    pool = multiprocessing.pool.ThreadPool(max(1, min(args.jobs, len(targets))))
+    sys.stdout = output
+    try:
+        # Waiting with a timeout (rather than using map()) lets Ctrl-C through.
+        results = pool.map_async(run, targets).get(sys.maxint)
+    except KeyboardInterrupt:
+        pool.terminate()
+        results = None
+    finally:
+        sys.stdout = output.stream
+    if results is None:
+        print("Batch interrupted.")
+        return 1
+    pool.close()
+    pool.join()
+    # Print each target's output together with how it went.
+    for target, (result, printed) in zip(targets, results):
+        print("*** {}".format(target))
+        sys.stdout.write(printed)
+        if result:
+            print("{}: failed ({})".format(target, result))
+        else:
+            print("{}: ok".format(target))
+    return max(result for result, printed in results)
+
 def find_default_sudoers_file():
     """
     Attempts to find a valid sudoers file being used by the system. This uses
@@ -581,7 +1671,9 @@ def show_help():
     """
     show_version()
     print('''\
-usage: {name} [-hvcrb] [-f file] [-d rule[,-d rule,...]] rule[,rule,...]
+usage: {name} [-hvcrbaw] [-f file[,-f file,...]] [--root root[,--root root,...]]
+       [--root-list list] [-j jobs] [-s state[,-s state,...]] [--store database]
+       [--export ndjson] [--import ndjson] [-d rule[,-d rule,...]] rule[,rule,...]
 
 Modify the sudoers file safely and atomically, keeping all of the rules
 organized into the appropriate sections.
@@ -606,9 +1698,57 @@ organized into the appropriate sections.
         Prevents the script from prompting for permission to migrate from an
         existing sudoers file that is not properly marked for use with Sudoers
         Manager.
+    --export ndjson
+        Writes every rule in the sudoers file to standard output as
+        newline-delimited JSON (one object per rule, with its section, rule,
+        line number, and owner) and quits. Other messages go to standard error.
+    --import ndjson
+        Reads rules from standard input as newline-delimited JSON (in the same
+        form as --export) and adds them along with any other rules given.
+    -a, --audit
+        Reports which sections of the sudoers file were edited by something
+        other than this script since it last wrote them, then quits. Exits
+        with 5 if any were. Each section's '#@end' marker holds a checksum of
+        the section for this purpose.
+    -w, --watch
+        After making the changes, keeps running and watches the sudoers file.
+        Whenever the rules in the file drift away from the requested rules
+        (e.g. somebody edits it by hand), the changes are made again. Uses
+        inotify where it is available, and polls the file otherwise.
+    --interval seconds
+        How often to check the file when --watch has to poll. Default is 5.
 
     -f file, --file file
-        Uses 'file' as the sudoers file instead of the system default.
+        Uses 'file' as the sudoers file instead of the system default. This may
+        be given more than once to make the same changes to several files.
+    --root root
+        Uses 'root/etc/sudoers' as a sudoers file, e.g. for a chroot or image
+        build root. This may be given more than once.
+    --root-list list
+        Reads more roots from the file 'list', one per line.
+    -j jobs, --jobs jobs
+        When there is more than one sudoers file, works on up to 'jobs' of them
+        at once (default is 4). Nobody is prompted, so use --create and
+        --migrate as needed. A summary is printed at the end, and the exit
+        status is the highest of any file's. Cannot be combined with --watch or
+        --store.
+    -s state, --state state
+        Converges the rules owned by the desired-state file 'state'. This is a
+        JSON object such as {{"owner": "web", "rules": ["rule", ...]}}. Rules
+        are tagged with their owner in the sudoers file, and only that owner's
+        rules are added or removed. If nothing changes, the file is left alone.
+    --store database
+        Uses the SQLite database 'database' as the source of truth for the
+        rules (it is created if it doesn't exist). Rules are added to and
+        removed from the database in a single transaction, and the sudoers file
+        is then built from the template with the rules in the database.
+    --store-import
+        With --store, imports all of the rules in the existing sudoers file
+        into the database (whether the file conforms or not).
+    --expires date
+        With --store, the rules given on the command line expire at 'date'
+        (e.g. '2026-12-31' or '2026-12-31 17:00:00') and are removed from the
+        database and the sudoers file on the first run after that.
     -d rule, --delete rule
         Removes rules from the list (if they exist). This will not cause an
         error if the specified rule is not in the list of rules.
@@ -645,13 +1785,23 @@ if __name__ == '__main__':
     parser.add_argument('--build-templated', '-b', action='store_true')
     parser.add_argument('--create', '-c', action='store_true') # prevents prompts
     parser.add_argument('--migrate', '-m', action='store_true') # prevents prompts too
-    parser.add_argument('--file', '-f')
+    parser.add_argument('--file', '-f', action='append', default=[])
+    parser.add_argument('--root', action='append', default=[]) # roots whose etc/sudoers to use
+    parser.add_argument('--root-list') # file listing more roots
+    parser.add_argument('--jobs', '-j', type=int, default=4) # targets to run at once
     parser.add_argument('--delete', '-d', action='append', default=[]) # rules to be removed
+    parser.add_argument('--state', '-s', action='append', default=[]) # desired-state files
+    parser.add_argument('--store')
+    parser.add_argument('--store-import', action='store_true')
+    parser.add_argument('--expires', type=expiry)
+    parser.add_argument('--export', dest='export_format', choices=['ndjson'])
+    parser.add_argument('--import', dest='import_format', choices=['ndjson']) # read from stdin
+    parser.add_argument('--audit', '-a', action='store_true')
+    parser.add_argument('--watch', '-w', action='store_true')
+    parser.add_argument('--interval', type=float, default=5.0) # polling period for --watch
     parser.add_argument('rules', nargs='*')
     # Parse the arguments.
     args = parser.parse_args()
-    # This is the default, blank rules dict.
-    rules = {key: [] for key in sections}
     # Print help information and quit.
     if args.help:
         show_help()
@@ -660,123 +1810,59 @@ if __name__ == '__main__':
     if args.version:
         show_version()
         sys.exit(0)
+    # When exporting, standard output is only for the export itself, so send
+    # anything else to standard error.
+    export_out = sys.stdout
+    if args.export_format:
+        sys.stdout = sys.stderr
+    # Gather up the user-specified locations, including those inside roots.
+    roots = args.root
+    if args.root_list:
+        roots = roots + read_root_list(args.root_list)
+    targets = [os.path.abspath(path) for path in args.file]
+    targets += [os.path.join(os.path.abspath(root), 'etc', 'sudoers') for root in roots]
+    targets = list(collections.OrderedDict.fromkeys(targets))
+    # Is there more than one file to take care of?
+    if len(targets) > 1:
+        if args.watch:
+            parser.error("--watch can only be used with a single sudoers file")
+        if args.store:
+            parser.error("--store can only be used with a single sudoers file")
+        if args.export_format or args.import_format:
+            parser.error("--export and --import can only be used with a single sudoers file")
+        sys.exit(run_batch(targets, args))
     # Should we use the default location?
-    if args.file:
+    if targets:
         # No, so set our location to the user-specified.
-        sudoers_file = os.path.abspath(args.file)
+        sudoers_file = targets[0]
     else:
         # Otherwise, find the default sudoers file location.
         sudoers_file = find_default_sudoers_file()
-    # Will we be creating from the template?
-    create_from_template = args.build_templated
-    # Does the file exist?
-    if os.path.isfile(sudoers_file):
-        # Yes, it exists. Do we care to save it?
-        if args.discard:
-            # Nope!
-            create_from_template = True
-        else:
-            # Let's save it. Does it conform to our specifications?
-            if validate(sudoers_file):
-                # Yes, it conforms. Should we replace the existing rules?
-                if not args.replace_rules:
-                    # No, don't replace them. Let's pull the existing rules from it.
-                    rules = get_rules_from_file(sudoers_file, args.verbose)
-            else:
-                # The file is not a conforming sudoers file for Sudoers Manager.
-                # Is the file even a system-recognized sudoers file?
-                if verify(sudoers_file):
-                    # Yes it is. Let's see if we should try to migrate.
-                    if args.migrate or prompt_user("The sudoers file doesn't conform. Would you like to migrate your existing rules to a new file?"):
-                        # Pull out the rules that are already in the file.
-                        rules = get_rules_from_nonconforming_file(sudoers_file)
-                        create_from_template = True
-                    else:
-                        # The user didn't want to migrate, so let's quit.
-                        print("The file that exists does not conform to Sudoers Manager specifications: {}".format(sudoers_file))
-                        sys.exit(4)
-                else:
-                    # The file is not valid, which is an error.
-                    print("No valid sudoers file exists at: {}".format(sudoers_file))
-                    sys.exit(3)
-    else:
-        # The file does not exist. Should we create a new file from template?
-        if args.create or prompt_user("No sudoers file exists. Would you like to create one from the template?"):
-            # Create the file from scratch.
-            create_from_template = True
-        else:
-            # The user didn't want to create the file from scratch, so quit.
-            print("No file exists and one is not going to be created at: {}".format(sudoers_file))
-            sys.exit(4)
-    # Add the user-specified rules to the rules dict.
-    for rule in args.rules:
-        rule = rule.strip()
-        added = False
-        # Try to match the rule to a specific section.
-        for section in sections:
-            if rule.startswith(section):
-                rules[section].append(rule)
-                added = True
-                break
-        # If the rule doesn't match a section, then it's a user specification.
-        if not added:
-            rules['User_Rule'].append(rule)
-    # Remove duplicate rules by throwing the list into an OrderedDict.
-    for section, rules_list in rules.iteritems():
-        rules_list = list(collections.OrderedDict.fromkeys(rules_list))
-        rules[section] = rules_list
-    # Remove rules specified for deletion.
-    for rule in args.delete:
-        for section, rules_list in rules.iteritems():
-            if rule in rules_list:
-                rules_list = [x for x in rules_list if x != rule]
-                rules[section] = rules_list
-    # Organize the defaults specification rules so that any rules beginning with
-    # 'Defaults:' will be pushed to the end of the list.
-    defaults_spec_rules  = []
-    defaults_rules_count = 0
-    for rule in rules['Defaults']:
-        # Is the rule a 'Defaults:' rule?
-        if rule.strip().startswith('Defaults:'):
-            # Yes, so push the rule to the end of the list.
-            defaults_spec_rules.append(rule)
-            defaults_rules_count += 1
-        else:
-            # No, so insert the rule after the previous non-'Defaults:' rules
-            # but ahead of the 'Defaults:' rules in the list.
-            defaults_spec_rules.insert(len(defaults_spec_rules) - defaults_rules_count, rule)
-    rules['Defaults'] = defaults_spec_rules
-    # Organize the user specification rules so that any ALL rules will be pushed
-    # to the end of the list.
-    user_spec_rules = []
-    all_rules_count = 0
-    for rule in rules['User_Rule']:
-        # Is the rule an 'ALL' rule?
-        if rule.strip().startswith('ALL'):
-            # Yes, so push the rule to the end of the list.
-            user_spec_rules.append(rule)
-            all_rules_count += 1
-        else:
-            # No, so insert the rule after the previous non-ALL rules but ahead
-            # of the ALL rules in the list.
-            user_spec_rules.insert(len(user_spec_rules) - all_rules_count, rule)
-    rules['User_Rule'] = user_spec_rules
-    # Sometimes empty strings sneak in there. Let's get rid of those.
-    for section, rules_list in rules.iteritems():
-        rules_list = [x for x in rules_list if x]
-        rules[section] = rules_list
-    # Should we create a new file from the template?
-    if create_from_template:
-        # Build the new file.
-        handle, temp_file = tempfile.mkstemp()
-        build_clean_from_template(temp_file)
-    else:
-        # Copy the original to a temp file.
-        handle, temp_file = tempfile.mkstemp()
-        shutil.copy(sudoers_file, temp_file)
-    # Write the changes to the temp file.
-    write_rules(rules, temp_file)
-    os.close(handle)
-    # Commit the changes from the temp file to the sudoers file.
-    commit(temp_file, sudoers_file)
+    # Report which sections were edited by hand and quit.
+    if args.audit:
+        sys.exit(audit(sudoers_file))
+    # Write out the rules and quit.
+    if args.export_format:
+        if not os.path.isfile(sudoers_file) or not validate(sudoers_file):
+            print("No valid sudoers file exists at: {}".format(sudoers_file))
+            sys.exit(3)
+        try:
+            export_ndjson(sudoers_file, export_out)
+        except IOError as e:
+            # It's fine if the reader stops early (e.g. '| head').
+            if e.errno != errno.EPIPE:
+                raise
+        sys.exit(0)
+    # Read the file, make the changes, and move the new file into place. When
+    # converging desired-state files or using the rule store, an unchanged file
+    # isn't rewritten. Standard input holds the imported rules, so nobody can be
+    # prompted while importing.
+    reconcile(sudoers_file, args, only_on_drift=bool(args.state or args.store),
+              interactive=not args.import_format)
     print("Done.")
+    # Should we stick around and keep the file reconciled?
+    if args.watch:
+        try:
+            watch(sudoers_file, args)
+        except KeyboardInterrupt:
+            print("Stopped watching.")